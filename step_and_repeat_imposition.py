@@ -1,10 +1,25 @@
 import argparse
 import os
+from typing import NamedTuple
 
 try:
-    from pypdf import PdfReader, PdfWriter, Transformation
+    from pypdf import PdfReader, PdfWriter
+    from pypdf.generic import (
+        ArrayObject,
+        DecodedStreamObject,
+        DictionaryObject,
+        FloatObject,
+        NameObject,
+    )
 except ImportError:
-    from PyPDF2 import PdfReader, PdfWriter, Transformation
+    from PyPDF2 import PdfReader, PdfWriter
+    from PyPDF2.generic import (
+        ArrayObject,
+        DecodedStreamObject,
+        DictionaryObject,
+        FloatObject,
+        NameObject,
+    )
 
 MM_TO_PT = 72 / 25.4  # 1 mm in punten
 
@@ -20,19 +35,43 @@ PAPER_SIZES_MM = {
 BACK_OFFSET_X_MM = -2.5
 BACK_OFFSET_Y_MM = 0.0
 
+# Buffergroottes voor het lezen/schrijven van de PDF's (in bytes)
+READ_BUFFER_SIZE = 1 << 20   # 1 MiB: pypdf leest veel kleine stukjes op willekeurige posities
+WRITE_BUFFER_SIZE = 1 << 22  # 4 MiB: minder write()-aanroepen bij grote vellen
+
 
 def mm_to_points(w_mm, h_mm):
     return w_mm * MM_TO_PT, h_mm * MM_TO_PT
 
 
+# Papierformaten in punten, één keer omgerekend bij het laden
+PAPER_SIZES_PT = {
+    name: mm_to_points(w_mm, h_mm) for name, (w_mm, h_mm) in PAPER_SIZES_MM.items()
+}
+
+
 def get_sheet_size(format_name):
     fmt = format_name.upper()
-    if fmt not in PAPER_SIZES_MM:
+    if fmt not in PAPER_SIZES_PT:
         raise ValueError(
             f"Onbekend papierformaat '{format_name}'. Kies uit: A4, A3, SRA4, SRA3."
         )
-    w_mm, h_mm = PAPER_SIZES_MM[fmt]
-    return mm_to_points(w_mm, h_mm)
+    return PAPER_SIZES_PT[fmt]
+
+
+def points_to_nm(value):
+    """Rondt een lengte in punten af op hele nanometers."""
+    return int(round(value / MM_TO_PT * 1_000_000))
+
+
+def fit_count(usable, card):
+    """
+    Hoeveel keer 'card' in 'usable' past (beide in punten).
+    Er wordt in hele nanometers gerekend, zodat een kaart die precies
+    past (bv. 4 x 52,5 mm op 210 mm) niet door een afrondingsfout in
+    de punten-omrekening een kolom of rij verliest.
+    """
+    return points_to_nm(usable) // points_to_nm(card)
 
 
 def compute_grid(card_w, card_h, usable_w, usable_h):
@@ -42,8 +81,8 @@ def compute_grid(card_w, card_h, usable_w, usable_h):
     binnen dat bruikbare gebied overblijft, zodat het grid
     daarbinnen gecentreerd staat.
     """
-    cols = int(usable_w // card_w)
-    rows = int(usable_h // card_h)
+    cols = fit_count(usable_w, card_w)
+    rows = fit_count(usable_h, card_h)
 
     if cols < 1 or rows < 1:
         raise ValueError(
@@ -60,71 +99,293 @@ def compute_grid(card_w, card_h, usable_w, usable_h):
     return cols, rows, margin_x, margin_y
 
 
-def impose_side(
-    writer,
-    base_page,
-    sheet_w,
-    sheet_h,
+def make_form_xobject(writer, contents, resources):
+    """
+    Maakt een Form XObject in de writer van een (al opgehaalde) content
+    stream en resource-dictionary van een pagina. De /BBox wordt pas
+    gezet als de trim bekend is (zie set_form_bbox).
+    De inhoud en resources worden één keer gekopieerd (inhoud Flate-
+    gecomprimeerd); daarna kan het XObject met 'Do' zo vaak als nodig
+    geplaatst worden.
+    """
+    data = contents.get_data() if contents is not None else b""
+
+    if resources is None:
+        resources = DictionaryObject()
+    else:
+        resources = resources.clone(writer)
+
+    form = DecodedStreamObject()
+    form.set_data(data)
+    form.update(
+        {
+            NameObject("/Type"): NameObject("/XObject"),
+            NameObject("/Subtype"): NameObject("/Form"),
+            NameObject("/Resources"): resources,
+        }
+    )
+    return writer._add_object(form.flate_encode())
+
+
+def set_form_bbox(form_ref, bbox):
+    """Zet de /BBox (llx, lly, urx, ury in punten) van een Form XObject."""
+    form_ref.get_object()[NameObject("/BBox")] = ArrayObject(
+        [FloatObject(v) for v in bbox]
+    )
+
+
+def load_card_forms(input_pdf, writer):
+    """
+    Leest voor- (p1) en achterzijde (p2) uit input_pdf en neemt ze elk één
+    keer als Form XObject in de writer op.
+    Geeft per zijde (form_ref, mediabox, cropbox) terug, de boxen als
+    (llx, lly, urx, ury) in punten. Het bestand wordt gebufferd gelezen en
+    is alleen open zolang er gelezen wordt; de reader en zijn cache van
+    ingelezen objecten verdwijnen na het teruggeven.
+    """
+    with open(input_pdf, "rb", buffering=READ_BUFFER_SIZE) as f_in:
+        reader = PdfReader(f_in)
+        if len(reader.pages) < 2:
+            raise ValueError(
+                "De input-PDF moet minstens 2 pagina's hebben (voor- en achterzijde)."
+            )
+
+        sides = []
+        for page in (reader.pages[0], reader.pages[1]):
+            form_ref = make_form_xobject(
+                writer,
+                page.get_contents(),
+                page.get("/Resources"),
+            )
+            sides.append(
+                (
+                    form_ref,
+                    tuple(float(v) for v in page.mediabox),
+                    tuple(float(v) for v in page.cropbox),
+                )
+            )
+
+    return sides
+
+
+class Scenario(NamedTuple):
+    """Eén combinatie van trim en rotatie met het bijbehorende grid."""
+
+    trim_mm: float
+    rotate: bool
+    cols: int
+    rows: int
+    inner_mx: float
+    inner_my: float
+    card_w_eff: float
+    card_h_eff: float
+    capacity: int
+
+
+def iter_scenarios(orig_w, orig_h, usable_w, usable_h, trim_candidates_mm=(0.0, 2.0)):
+    """
+    Levert voor elke combinatie van trim en rotatie die past een Scenario op.
+    orig_w/h: originele kaartmaat (zonder trim), in punten.
+
+    De combinaties worden in volgorde van voorkeur afgelopen (minder trim,
+    geen rotatie eerst). Een latere combinatie wint dus alleen bij een
+    strikt grotere capaciteit; combinaties die dat niet halen worden niet
+    opgeleverd.
+    """
+    best_capacity = 0
+    usable_area_nm = points_to_nm(usable_w) * points_to_nm(usable_h)
+
+    for trim_mm in trim_candidates_mm:
+        trim_pts = trim_mm * MM_TO_PT
+        card_w = orig_w - 2 * trim_pts if trim_mm > 0 else orig_w
+        card_h = orig_h - 2 * trim_pts if trim_mm > 0 else orig_h
+
+        if card_w <= 0 or card_h <= 0:
+            continue
+
+        # Meer kaarten dan oppervlak bruikbaar / oppervlak kaart past nooit,
+        # in geen enkele oriëntatie: levert deze trim geen winst op, dan
+        # hoeven beide rotaties niet bekeken te worden.
+        card_area_nm = points_to_nm(card_w) * points_to_nm(card_h)
+        if usable_area_nm // card_area_nm <= best_capacity:
+            continue
+
+        for rotate in (False, True):
+            if rotate:
+                card_w_eff = card_h
+                card_h_eff = card_w
+            else:
+                card_w_eff = card_w
+                card_h_eff = card_h
+
+            try:
+                cols, rows, inner_mx, inner_my = compute_grid(
+                    card_w_eff,
+                    card_h_eff,
+                    usable_w,
+                    usable_h,
+                )
+            except ValueError:
+                continue
+
+            if cols * rows <= best_capacity:
+                continue
+
+            best_capacity = cols * rows
+            yield Scenario(
+                trim_mm,
+                rotate,
+                cols,
+                rows,
+                inner_mx,
+                inner_my,
+                card_w_eff,
+                card_h_eff,
+                cols * rows,
+            )
+
+
+def build_grid_content(
+    form_name,
     cols,
     rows,
     margin_x,
     margin_y,
     card_w_eff,
     card_h_eff,
+    card_h_raw,
     rotate=False,
 ):
     """
-    Maakt één nieuw vel en zet daar base_page in een grid.
+    Bouwt de content stream voor één vel: per kaartje een
+    'q ... cm /Fm0 Do Q' die het Form XObject form_name plaatst.
     'margin_x' en 'margin_y' zijn de afstanden van de papierrand
     tot het eerste kaartje (in punten).
     card_w_eff/h_eff zijn de effectieve kaartafmetingen in het grid
     (dus eventueel gewisseld bij rotatie).
+    card_h_raw is de hoogte van de kaart zelf (na eventuele trim), nodig
+    om een geroteerde kaart weer op zijn plek te schuiven.
+    Geeft de ruwe bytes terug; er wordt niets aan een writer toegevoegd.
     """
-    new_page = writer.add_blank_page(width=sheet_w, height=sheet_h)
+    # Rotatie is altijd 0° of 90°, dus het lineaire deel van de CTM ligt vast;
+    # alleen de translatie verschilt per kaartje.
+    if rotate:
+        # 90° CCW om (0,0), daarna verplaatsen
+        a, b, c, d = 0, 1, -1, 0
+        shift_x = card_h_raw
+    else:
+        a, b, c, d = 1, 0, 0, 1
+        shift_x = 0.0
 
-    card_w_raw = float(base_page.mediabox.width)
-    card_h_raw = float(base_page.mediabox.height)
+    # Posities per kolom en per rij maar één keer formatteren; elke regel is
+    # daarna alleen nog een samenvoeging van kant-en-klare bytes.
+    xs = [
+        b"%.3f" % (margin_x + col * card_w_eff + shift_x) for col in range(cols)
+    ]
+    ys = [b"%.3f" % (margin_y + row * card_h_eff) for row in range(rows)]
+    prefix = b"q %d %d %d %d " % (a, b, c, d)
+    suffix = b" cm %s Do Q\n" % form_name.encode("ascii")
 
-    for row in range(rows):
-        for col in range(cols):
-            x = margin_x + col * card_w_eff
-            y = margin_y + row * card_h_eff
+    return b"".join(prefix + x + b" " + y + suffix for y in ys for x in xs)
 
-            if rotate:
-                # 90° CCW om (0,0), daarna verplaatsen
-                t = Transformation().rotate(90).translate(
-                    tx=x + card_h_raw,
-                    ty=y,
-                )
-            else:
-                t = Transformation().translate(tx=x, ty=y)
 
-            new_page.merge_transformed_page(base_page, t)
+def add_content_stream(writer, data, compress=True):
+    """
+    Voegt een content stream toe aan de writer, standaard Flate-gecomprimeerd.
+    Voor een paar bytes (zoals 'Q') levert compressie alleen overhead op;
+    geef dan compress=False mee.
+    """
+    content = DecodedStreamObject()
+    content.set_data(data)
+    if compress:
+        content = content.flate_encode()
+    return writer._add_object(content)
+
+
+def impose_side(
+    writer,
+    form_ref,
+    form_name,
+    grid_ref,
+    sheet_w,
+    sheet_h,
+    offset_x=0.0,
+    offset_y=0.0,
+):
+    """
+    Maakt één nieuw vel met het grid uit grid_ref (een content stream van
+    build_grid_content, zie add_content_stream).
+    form_ref (zie make_form_xobject) wordt onder form_name (bv. '/Fm0')
+    in de resources van het vel opgenomen; dat moet dezelfde naam zijn
+    als waarmee het grid gebouwd is.
+    Met offset_x/offset_y (in punten) wordt het hele grid met één
+    buitenste 'cm' verschoven, zodat hetzelfde grid gedeeld kan worden.
+    """
+    new_page = writer.add_blank_page(width=sheet_w, height=sheet_h)
+
+    new_page[NameObject("/Resources")] = DictionaryObject(
+        {
+            NameObject("/XObject"): DictionaryObject(
+                {NameObject(form_name): form_ref}
+            )
+        }
+    )
+
+    if offset_x or offset_y:
+        contents = ArrayObject(
+            [
+                add_content_stream(
+                    writer,
+                    b"q 1 0 0 1 %.3f %.3f cm\n" % (offset_x, offset_y),
+                    compress=False,
+                ),
+                grid_ref,
+                add_content_stream(writer, b"Q\n", compress=False),
+            ]
+        )
+    else:
+        contents = grid_ref
+    new_page[NameObject("/Contents")] = contents
 
     return new_page
 
 
-def crop_page_all_sides(page, trim_loss_mm):
-    """Knipt aan alle kanten trim_loss_mm af van de mediabox."""
-    if trim_loss_mm <= 0:
-        return
+def trimmed_card_box(mediabox, cropbox, trim_loss_mm):
+    """
+    Geeft het zichtbare kaartkader als (llx, lly, urx, ury) terug:
+    de mediabox met aan alle kanten trim_loss_mm eraf, begrensd door de
+    cropbox van de pagina (zodat bijv. afloop buiten de cropbox wegvalt).
+    mediabox en cropbox zijn (llx, lly, urx, ury) in punten; het kader
+    wordt als /BBox van het Form XObject gebruikt.
+    """
+    llx, lly, urx, ury = mediabox
+
+    if trim_loss_mm > 0:
+        trim_pts = trim_loss_mm * MM_TO_PT
+
+        llx += trim_pts
+        lly += trim_pts
+        urx -= trim_pts
+        ury -= trim_pts
 
-    trim_pts = trim_loss_mm * MM_TO_PT
-    llx, lly = page.mediabox.lower_left
-    urx, ury = page.mediabox.upper_right
+        if urx <= llx or ury <= lly:
+            raise ValueError(
+                "Te veel trim_loss_mm: er blijft geen bruikbaar kaartformaat over."
+            )
+
+    crop_llx, crop_lly, crop_urx, crop_ury = cropbox
 
-    new_llx = llx + trim_pts
-    new_lly = lly + trim_pts
-    new_urx = urx - trim_pts
-    new_ury = ury - trim_pts
+    llx = max(llx, crop_llx)
+    lly = max(lly, crop_lly)
+    urx = min(urx, crop_urx)
+    ury = min(ury, crop_ury)
 
-    if new_urx <= new_llx or new_ury <= new_lly:
+    if urx <= llx or ury <= lly:
         raise ValueError(
-            "Te veel trim_loss_mm: er blijft geen bruikbaar kaartformaat over."
+            "De cropbox van de pagina valt buiten het (getrimde) kaartformaat."
         )
 
-    page.mediabox.lower_left = (new_llx, new_lly)
-    page.mediabox.upper_right = (new_urx, new_ury)
+    return llx, lly, urx, ury
 
 
 def main():
@@ -196,19 +457,26 @@ def main():
         margin_x_mm = args.margin_x_mm
         margin_y_mm = args.margin_y_mm
 
-    # Lees input
-    reader = PdfReader(args.input_pdf)
-    if len(reader.pages) < 2:
-        raise ValueError(
-            "De input-PDF moet minstens 2 pagina's hebben (voor- en achterzijde)."
-        )
+    writer = PdfWriter()
 
-    front_page = reader.pages[0]
-    back_page = reader.pages[1]
+    # Lees input: voor- en achterzijde worden meteen Form XObjects
+    front, back = load_card_forms(args.input_pdf, writer)
+    front_form, front_mediabox, front_cropbox = front
+    back_form, back_mediabox, back_cropbox = back
 
     # Originele kaartmaat (zonder trim)
-    orig_w = float(front_page.mediabox.width)
-    orig_h = float(front_page.mediabox.height)
+    orig_w = front_mediabox[2] - front_mediabox[0]
+    orig_h = front_mediabox[3] - front_mediabox[1]
+
+    # Beide zijden delen hetzelfde grid (ook de verschuiving bij rotatie),
+    # dus de achterzijde moet even groot zijn als de voorzijde
+    back_w = back_mediabox[2] - back_mediabox[0]
+    back_h = back_mediabox[3] - back_mediabox[1]
+    if abs(back_w - orig_w) > 0.01 or abs(back_h - orig_h) > 0.01:
+        raise ValueError(
+            "Voor- en achterzijde hebben een verschillend formaat "
+            f"({orig_w:.2f} x {orig_h:.2f} pt vs. {back_w:.2f} x {back_h:.2f} pt)."
+        )
 
     # Velformaat
     sheet_w, sheet_h = get_sheet_size(args.paper)
@@ -224,75 +492,35 @@ def main():
         raise ValueError("Printmarge is te groot voor het gekozen papierformaat.")
 
     # Scenario's: (trim_mm = 0 of 2) x (rotate = False of True)
-    scenarios = []
-    trim_candidates_mm = [0.0, 2.0]
-
-    for trim_mm in trim_candidates_mm:
-        trim_pts = trim_mm * MM_TO_PT
-        card_w = orig_w - 2 * trim_pts if trim_mm > 0 else orig_w
-        card_h = orig_h - 2 * trim_pts if trim_mm > 0 else orig_h
-
-        if card_w <= 0 or card_h <= 0:
-            continue
-
-        for rotate in (False, True):
-            if rotate:
-                card_w_eff = card_h
-                card_h_eff = card_w
-            else:
-                card_w_eff = card_w
-                card_h_eff = card_h
-
-            try:
-                cols, rows, inner_mx, inner_my = compute_grid(
-                    card_w_eff,
-                    card_h_eff,
-                    usable_w,
-                    usable_h,
-                )
-                capacity = cols * rows
-            except ValueError:
-                continue
-
-            scenarios.append(
-                {
-                    "trim_mm": trim_mm,
-                    "rotate": rotate,
-                    "cols": cols,
-                    "rows": rows,
-                    "inner_mx": inner_mx,
-                    "inner_my": inner_my,
-                    "card_w_eff": card_w_eff,
-                    "card_h_eff": card_h_eff,
-                    "capacity": capacity,
-                }
-            )
+    # Kies scenario met maximale capaciteit.
+    # Bij gelijke capaciteit: voorkeur voor minder trim en geen rotatie.
+    best = max(
+        iter_scenarios(orig_w, orig_h, usable_w, usable_h),
+        key=lambda s: (s.capacity, -s.trim_mm, 0 if s.rotate else 1),
+        default=None,
+    )
 
-    if not scenarios:
+    if best is None:
         raise ValueError(
             "Er past geen kaart op het gekozen papierformaat met de opgegeven printmarge, "
             "zelfs niet met 2 mm trim of rotatie."
         )
 
-    # Kies scenario met maximale capaciteit.
-    # Bij gelijke capaciteit: voorkeur voor minder trim en geen rotatie.
-    scenarios.sort(
-        key=lambda s: (s["capacity"], -s["trim_mm"], not s["rotate"]),
-        reverse=True,
+    # Zichtbaar kaartkader na eventuele trim wordt de /BBox van de Form XObjects
+    set_form_bbox(
+        front_form, trimmed_card_box(front_mediabox, front_cropbox, best.trim_mm)
+    )
+    set_form_bbox(
+        back_form, trimmed_card_box(back_mediabox, back_cropbox, best.trim_mm)
     )
-    best = scenarios[0]
-
-    # Trim nu daadwerkelijk toepassen (indien gekozen)
-    if best["trim_mm"] > 0:
-        crop_page_all_sides(front_page, best["trim_mm"])
-        crop_page_all_sides(back_page, best["trim_mm"])
 
-    # Afmetingen na eventuele trim
-    final_card_w = float(front_page.mediabox.width)
-    final_card_h = float(front_page.mediabox.height)
+    # Afmetingen na eventuele trim (mediabox, bepaalt de plaatsing in het grid)
+    trim_pts = best.trim_mm * MM_TO_PT
+    final_card_w = orig_w - 2 * trim_pts
+    final_card_h = orig_h - 2 * trim_pts
 
     # Bepaal effectieve kaartmaat in grid voor gekozen rotatie
-    if best["rotate"]:
+    if best.rotate:
         card_w_eff = final_card_h
         card_h_eff = final_card_w
     else:
@@ -300,8 +528,8 @@ def main():
         card_h_eff = final_card_h
 
     # Grid-omvang en centrering op HET HELE VEL
-    grid_w = best["cols"] * card_w_eff
-    grid_h = best["rows"] * card_h_eff
+    grid_w = best.cols * card_w_eff
+    grid_h = best.rows * card_h_eff
 
     margin_x = (sheet_w - grid_w) / 2.0
     margin_y = (sheet_h - grid_h) / 2.0
@@ -319,10 +547,10 @@ def main():
         f"{margin_y_mm} mm boven/onder"
     )
     print("Gekozen scenario:")
-    print(f"  - capaciteit : {best['capacity']} kaarten per vel")
-    print(f"  - trim       : {best['trim_mm']} mm rondom")
-    print(f"  - rotatie    : {'JA (90°)' if best['rotate'] else 'NEE'}")
-    print(f"  - grid       : {best['cols']} kolommen x {best['rows']} rijen")
+    print(f"  - capaciteit : {best.capacity} kaarten per vel")
+    print(f"  - trim       : {best.trim_mm} mm rondom")
+    print(f"  - rotatie    : {'JA (90°)' if best.rotate else 'NEE'}")
+    print(f"  - grid       : {best.cols} kolommen x {best.rows} rijen")
     print(
         "Eind-kaartformaat (zonder rekening te houden met rotatie): "
         f"{final_card_w:.2f} x {final_card_h:.2f} pt"
@@ -332,43 +560,43 @@ def main():
         f"BACK_OFFSET_Y_MM = {BACK_OFFSET_Y_MM}"
     )
 
-    writer = PdfWriter()
-
     # Offset voor achterkant in punten
     back_offset_x = BACK_OFFSET_X_MM * MM_TO_PT
     back_offset_y = BACK_OFFSET_Y_MM * MM_TO_PT
 
-    # Voorzijde
-    impose_side(
+    # Eén grid voor beide zijden: elk vel kent zijn eigen Form XObject
+    # onder dezelfde naam /Fm0
+    grid_ref = add_content_stream(
         writer,
-        front_page,
-        sheet_w,
-        sheet_h,
-        best["cols"],
-        best["rows"],
-        margin_x,
-        margin_y,
-        card_w_eff,
-        card_h_eff,
-        rotate=best["rotate"],
+        build_grid_content(
+            "/Fm0",
+            best.cols,
+            best.rows,
+            margin_x,
+            margin_y,
+            card_w_eff,
+            card_h_eff,
+            final_card_h,
+            rotate=best.rotate,
+        ),
     )
 
+    # Voorzijde
+    impose_side(writer, front_form, "/Fm0", grid_ref, sheet_w, sheet_h)
+
     # Achterzijde – zelfde grid, maar met kleine correctie voor duplex-afwijking
     impose_side(
         writer,
-        back_page,
+        back_form,
+        "/Fm0",
+        grid_ref,
         sheet_w,
         sheet_h,
-        best["cols"],
-        best["rows"],
-        margin_x + back_offset_x,
-        margin_y + back_offset_y,
-        card_w_eff,
-        card_h_eff,
-        rotate=best["rotate"],
+        offset_x=back_offset_x,
+        offset_y=back_offset_y,
     )
 
-    with open(output_pdf, "wb") as f_out:
+    with open(output_pdf, "wb", buffering=WRITE_BUFFER_SIZE) as f_out:
         writer.write(f_out)
 
     print(f"Gereed. Opgeslagen als: {output_pdf}")